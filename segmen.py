@@ -9,22 +9,96 @@ Original file is located at
 
 import streamlit as st
 import pandas as pd
-import geopandas as gpd
-from shapely.geometry import Point
-from sklearn.preprocessing import StandardScaler
-import plotly.express as px
+import numpy as np
+import pyproj
+import pydeck as pdk
+from matplotlib import cm
 import io
+import hashlib
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from scipy.spatial import cKDTree
+from scipy.sparse import csr_matrix
+
+# scikit-learn imports
+from sklearn.cluster import AgglomerativeClustering # Connectivity-constrained Ward linkage
+
+# Optional RAPIDS GPU backend for the KNN graph
+try:
+    import cuml
+    CUML_AVAILABLE = True
+except ImportError:
+    CUML_AVAILABLE = False
+
+# Core columns are cast after parsing: passing dtype= to the pyarrow engine makes pandas 3 fail on
+# blank cells in any other integer-like column (e.g. zip_code). Lat/lon stay float64 so the display,
+# map and export round-trip the user's coordinates; the clustering path downcasts its own copies.
+CORE_DTYPES = {'hcp_id': 'string', 'trx_count': 'float32', 'latitude': 'float64', 'longitude': 'float64'}
+
+GPU_MIN_POINTS = 50_000 # Below this the transfer overhead outweighs the GPU speedup
+TERRITORY_COLORS = (np.asarray(cm.tab20.colors) * 255).astype(np.uint8) # uint8 RGB rows, indexed by cluster id modulo 20
+
+# --- Preprocessing ---
+# None of these depend on the number of territories. Their results are kept in
+# st.session_state keyed on the upload's hash (KNN graphs additionally on k), so
+# slider changes skip them entirely and only the Ward clustering re-executes.
+def load_csv(file_bytes):
+    """Parse the uploaded CSV bytes into a DataFrame with the multithreaded pyarrow engine."""
+    if not file_bytes.strip():
+        # The pyarrow engine reports an empty file as a generic ParserError
+        raise pd.errors.EmptyDataError("No columns to parse from file")
+    return pd.read_csv(io.BytesIO(file_bytes), engine='pyarrow')
+
+
+def to_projected(df):
+    """Build the EPSG:5070 proj_x/proj_y/trx_count frame used for clustering."""
+    lon = df['longitude'].to_numpy()
+    lat = df['latitude'].to_numpy()
+
+    # Ward's criterion is a Euclidean variance, so the attributes must be planar; lat/lon
+    # degrees are not. The KNN graph reuses the same coordinates, so a separate haversine
+    # neighbour search on lat/lon would add work rather than remove this step.
+    # Only x/y are needed, so transform the arrays directly instead of rebuilding geometries with to_crs.
+    transformer = pyproj.Transformer.from_crs(4326, 5070, always_xy=True) # NAD83 / Conus Albers
+    proj_x, proj_y = transformer.transform(lon, lat)
+    # FP32 halves the bytes moved by the KNN and Ward steps. At Conus Albers magnitudes
+    # (~1e6 m) it still resolves to well under a metre, far finer than HCP spacing.
+    df_projected = pd.DataFrame({'proj_x': np.asarray(proj_x, dtype=np.float32),
+                                 'proj_y': np.asarray(proj_y, dtype=np.float32),
+                                 'trx_count': df['trx_count'].to_numpy()},
+                                index=df.index)
+    return df_projected
+
+
+def build_knn_connectivity(coords, k, use_gpu=False):
+    """Build a symmetric sparse KNN connectivity matrix from an (N, 2) coordinate array."""
+    n_points = len(coords)
+    if use_gpu and CUML_AVAILABLE and n_points > GPU_MIN_POINTS:
+        nn = cuml.neighbors.NearestNeighbors(n_neighbors=k + 1).fit(coords)
+        knn_idx = np.asarray(nn.kneighbors(coords, return_distance=False))
+    else:
+        # A KD-tree is O(N log N) on 2-D points; brute-force GEMM indexes (e.g. FAISS IndexFlatL2) are O(N^2) here
+        tree = cKDTree(coords)
+        _, knn_idx = tree.query(coords, k=k + 1, workers=-1)
+    # Drop each point's own entry. It is usually column 0, but coincident
+    # HCPs can push it further right (or out of the result entirely).
+    self_hit = knn_idx == np.arange(n_points)[:, None]
+    self_hit[:, -1] |= ~self_hit.any(axis=1)
+    knn_idx = knn_idx[~self_hit].reshape(n_points, k)
+    # Row i holds exactly k entries, so the CSR arrays come straight from knn_idx
+    indptr = np.arange(0, n_points * k + 1, k, dtype=np.int32)
+    indices = knn_idx.ravel().astype(np.int32)
+    data = np.ones(indices.size, dtype=np.float32)
+    knn_sparse = csr_matrix((data, indices, indptr), shape=(n_points, n_points))
+    return knn_sparse.maximum(knn_sparse.T)
 
-# PySAL and spopt imports
-import libpysal
-from spopt.region import WardSpatial # Using WardSpatial
 
 # --- Streamlit Page Configuration ---
-st.set_page_config(layout="wide", page_title="HCP Geospatial Segmentation (WardSpatial)")
+st.set_page_config(layout="wide", page_title="HCP Geospatial Segmentation (Spatial Ward)")
 
-st.title("Interactive HCP Geospatial Segmentation Tool (with WardSpatial)")
+st.title("Interactive HCP Geospatial Segmentation Tool (with Spatial Ward)")
 st.markdown("""
-This tool uses the **WardSpatial algorithm** for spatially constrained hierarchical clustering,
+This tool uses **Ward's linkage constrained to a KNN connectivity graph** for spatially constrained hierarchical clustering,
 aiming to create geographically coherent territories by minimizing within-cluster variance.
 
 **Instructions:**
@@ -40,112 +114,121 @@ uploaded_file = st.file_uploader("1. Upload your HCP Data (CSV)", type="csv")
 
 if uploaded_file is not None:
     try:
-        df = pd.read_csv(uploaded_file)
-        st.success("File Uploaded Successfully!")
+        file_bytes = uploaded_file.getvalue()
+        file_hash = hashlib.md5(file_bytes).hexdigest()
 
-        # --- Data Validation ---
-        required_columns = ['hcp_id', 'trx_count', 'latitude', 'longitude']
-        optional_geo_columns = ['state', 'city', 'zip_code']
-        present_optional_geo = [col for col in optional_geo_columns if col in df.columns]
+        # Widget changes rerun the whole script, so only load/validate/project when the upload changes
+        if st.session_state.get('file_hash') != file_hash:
+            df = load_csv(file_bytes)
 
-        if not all(col in df.columns for col in required_columns):
-            st.error(f"Error: CSV must contain the core columns: {', '.join(required_columns)}")
-            st.stop()
+            # --- Data Validation ---
+            required_columns = ['hcp_id', 'trx_count', 'latitude', 'longitude']
+            if not all(col in df.columns for col in required_columns):
+                st.error(f"Error: CSV must contain the core columns: {', '.join(required_columns)}")
+                st.stop()
 
-        try:
-            df['trx_count'] = pd.to_numeric(df['trx_count'])
-            df['latitude'] = pd.to_numeric(df['latitude'])
-            df['longitude'] = pd.to_numeric(df['longitude'])
-        except ValueError as e:
-            st.error(f"Error converting data to numeric types. Please check 'trx_count', 'latitude', 'longitude'. Details: {e}")
-            st.stop()
+            for col, dtype in CORE_DTYPES.items():
+                try:
+                    df[col] = df[col].astype(dtype)
+                except (ValueError, TypeError) as e:
+                    st.error(f"Error converting column '{col}' to {dtype}. Please check its values. Details: {e}")
+                    st.stop()
+
+            initial_rows = len(df)
+            # RangeIndex keeps df_cleaned, df_projected and the label array positionally aligned
+            df_cleaned = df.dropna(subset=['trx_count', 'latitude', 'longitude']).reset_index(drop=True)
+            if len(df_cleaned) < 5: # Ward clustering might need a few points
+                 st.error("Error: Not enough valid data (minimum ~5 recommended).")
+                 st.stop()
+
+            # --- Project Coordinates ---
+            st.write("DEBUG: Projecting coordinates...")
+            # Projected coordinates are added as proj_x/proj_y columns for Ward attributes
+            df_projected = to_projected(df_cleaned)
+            st.write(f"DEBUG: Data projected to EPSG:5070.")
+
+            st.session_state['df_preview'] = df.head()
+            st.session_state['rows_dropped'] = initial_rows - len(df_cleaned)
+            st.session_state['df_cleaned'] = df_cleaned
+            st.session_state['df_projected'] = df_projected
+            st.session_state['weights_by_k'] = {} # KNN connectivity per k for this upload
+            st.session_state['file_hash'] = file_hash # Set last, so a failed load is retried
+
+        df_cleaned = st.session_state['df_cleaned']
+        df_projected = st.session_state['df_projected']
+        st.success("File Uploaded Successfully!")
+
+        optional_geo_columns = ['state', 'city', 'zip_code']
+        present_optional_geo = [col for col in optional_geo_columns if col in df_cleaned.columns]
 
         st.write("### Input Data Preview (First 5 Rows)")
-        st.dataframe(df.head())
+        st.dataframe(st.session_state['df_preview'])
 
-        initial_rows = len(df)
-        df_cleaned = df.dropna(subset=['trx_count', 'latitude', 'longitude']).copy()
-        rows_dropped = initial_rows - len(df_cleaned)
+        rows_dropped = st.session_state['rows_dropped']
         if rows_dropped > 0:
             st.warning(f"Warning: Dropped {rows_dropped} rows due to missing values in core columns.")
 
-        if len(df_cleaned) < 5: # WardSpatial might need a few points
-             st.error("Error: Not enough valid data (minimum ~5 recommended).")
-             st.stop()
-
-        # --- Convert to GeoDataFrame and Project ---
-        st.write("DEBUG: Converting to GeoDataFrame and projecting coordinates...")
-        geometry = [Point(xy) for xy in zip(df_cleaned['longitude'], df_cleaned['latitude'])]
-        gdf = gpd.GeoDataFrame(df_cleaned, geometry=geometry, crs="EPSG:4326")
-        gdf_projected = gdf.to_crs("EPSG:5070") # NAD83 / Conus Albers
-        st.write(f"DEBUG: Data projected to EPSG:5070.")
-
-        # Add projected coordinates as columns for WardSpatial attributes
-        gdf_projected['proj_x'] = gdf_projected.geometry.x
-        gdf_projected['proj_y'] = gdf_projected.geometry.y
 
+        # --- User Input for Spatial Ward Parameters ---
+        st.sidebar.header("Spatial Ward Segmentation Parameters")
+        n_territories = st.sidebar.slider("2. Number of Territories (Clusters):", min_value=2, max_value=min(50, len(df_projected)//2), value=min(5, len(df_projected)//2), step=1)
 
-        # --- User Input for WardSpatial Parameters ---
-        st.sidebar.header("WardSpatial Segmentation Parameters")
-        n_territories = st.sidebar.slider("2. Number of Territories (Clusters):", min_value=2, max_value=min(50, len(gdf_projected)//2), value=min(5, len(gdf_projected)//2), step=1)
-
-        max_k_neighbors = len(gdf_projected) - 1
+        max_k_neighbors = len(df_projected) - 1
         if max_k_neighbors < 1:
             st.error("Not enough data points to define neighbors.")
             st.stop()
         k_neighbors = st.sidebar.slider("Number of Neighbors (for connectivity graph):", min_value=1, max_value=min(15, max_k_neighbors), value=min(5,max_k_neighbors), step=1)
+        use_gpu = st.sidebar.checkbox("Use GPU (if available)", value=CUML_AVAILABLE, disabled=not CUML_AVAILABLE,
+                                      help=f"Builds the KNN graph with RAPIDS cuML for datasets over {GPU_MIN_POINTS:,} HCPs. "
+                                           "The Ward clustering itself always runs on the CPU.")
 
 
-        # --- WardSpatial Execution ---
+        # --- Spatial Ward Execution ---
         st.markdown("---")
-        if st.button(f"3. Run WardSpatial Segmentation for {n_territories} Territories", type="primary"):
-            with st.spinner('Building spatial weights and running WardSpatial... This may take a moment.'):
+        if st.button(f"3. Run Spatial Ward Segmentation for {n_territories} Territories", type="primary"):
+            with st.spinner('Building spatial weights and running Spatial Ward... This may take a moment.'):
 
-                # --- Prepare attributes for WardSpatial ---
+                # --- Prepare attributes for Ward clustering ---
                 # We will use scaled projected coordinates and scaled trx_count
                 attrs_for_ward = ['proj_x', 'proj_y', 'trx_count']
-                data_for_ward = gdf_projected[attrs_for_ward].copy()
-
-                # Scale these attributes
-                scaler = StandardScaler()
-                data_for_ward_scaled = scaler.fit_transform(data_for_ward)
-
-                # Create a new DataFrame with scaled attributes for WardSpatial
-                # WardSpatial expects attributes directly in the GeoDataFrame or as a separate array/df
-                # For simplicity, let's add scaled columns to gdf_projected temporarily
-                gdf_projected_scaled_attrs = gdf_projected.copy()
-                gdf_projected_scaled_attrs['scaled_proj_x'] = data_for_ward_scaled[:, 0]
-                gdf_projected_scaled_attrs['scaled_proj_y'] = data_for_ward_scaled[:, 1]
-                gdf_projected_scaled_attrs['scaled_trx_count'] = data_for_ward_scaled[:, 2]
+                data_for_ward = df_projected[attrs_for_ward].to_numpy(np.float32)
 
-                attrs_name_scaled = ['scaled_proj_x', 'scaled_proj_y', 'scaled_trx_count']
-                st.write(f"DEBUG: Attributes for WardSpatial (scaled): {attrs_name_scaled}")
+                # Z-score these attributes (zero-variance columns are left unscaled, as StandardScaler did)
+                ward_std = data_for_ward.std(axis=0)
+                ward_std[ward_std == 0] = 1.0
+                data_for_ward_scaled = (data_for_ward - data_for_ward.mean(axis=0)) / ward_std
+                st.write(f"DEBUG: Attributes for Ward clustering (scaled): {attrs_for_ward}")
 
-                # Create KNN spatial weights matrix from projected coordinates
-                st.write(f"DEBUG: Building KNN weights matrix with k={k_neighbors}...")
+                # Create KNN connectivity matrix from projected coordinates
+                st.write(f"DEBUG: Building KNN connectivity matrix with k={k_neighbors}...")
                 try:
-                    gdf_projected = gdf_projected.set_geometry('geometry') # Ensure active geometry
-                    knn_weights = libpysal.weights.KNN.from_dataframe(gdf_projected, k=k_neighbors)
-                    st.write("DEBUG: KNN weights matrix built.")
+                    weights_by_k = st.session_state['weights_by_k']
+                    if k_neighbors not in weights_by_k:
+                        weights_by_k[k_neighbors] = build_knn_connectivity(df_projected[['proj_x', 'proj_y']].to_numpy(), k_neighbors, use_gpu)
+                    knn_sparse = weights_by_k[k_neighbors]
+                    st.write("DEBUG: KNN connectivity matrix built.")
                 except Exception as e_weights:
                     st.error(f"Error building spatial weights: {e_weights}")
                     st.stop()
 
-                # --- Run WardSpatial ---
-                st.write("DEBUG: Running WardSpatial algorithm...")
-                model_ward = WardSpatial(
-                    gdf_projected_scaled_attrs, # Use GDF with scaled attributes
-                    w=knn_weights,
-                    attrs_name=attrs_name_scaled, # Use names of scaled attribute columns
-                    n_clusters=n_territories
-                )
-                model_ward.solve()
-                st.write("DEBUG: WardSpatial solved.")
-
-                # Assign cluster labels back to the original GeoDataFrame (gdf)
-                gdf.loc[gdf_projected_scaled_attrs.index, 'cluster'] = model_ward.labels_
-
-            st.success(f"WardSpatial Segmentation Complete! {n_territories} territories generated.")
+                # --- Run Ward clustering ---
+                # Merges are only allowed along (symmetrized) KNN edges, which keeps territories contiguous.
+                # sklearn's Cython ward_tree walks only those edges with a heap, so memory stays linear
+                # in the number of edges rather than building an N x N distance matrix.
+                st.write("DEBUG: Running Ward clustering...")
+                model_ward = AgglomerativeClustering(
+                    n_clusters=n_territories,
+                    linkage='ward',
+                    connectivity=knn_sparse
+                ).fit(data_for_ward_scaled)
+                st.write("DEBUG: Ward clustering solved.")
+
+                # Assign cluster labels back to a copy of the cleaned data (df_cleaned) by position,
+                # leaving the session's preprocessed frame untouched for later runs
+                df_cleaned = df_cleaned.copy()
+                df_cleaned['cluster'] = np.asarray(model_ward.labels_, dtype=np.int32)
+
+            st.success(f"Spatial Ward Segmentation Complete! {n_territories} territories generated.")
             st.markdown("---")
 
             # --- Display Results ---
@@ -155,24 +238,33 @@ if uploaded_file is not None:
             st.write("#### Interactive Map of Territories")
             st.markdown("HCP locations colored by assigned territory. Hover for details.")
             try:
-                gdf['cluster'] = gdf['cluster'].astype(str)
-                hover_data_dict = {"latitude": False, "longitude": False, "cluster": True, "trx_count": True}
-                for col in present_optional_geo:
-                    if col in gdf.columns: hover_data_dict[col] = True
-
-                fig = px.scatter_mapbox(gdf.dropna(subset=['cluster']),
-                                        lat="latitude",
-                                        lon="longitude",
-                                        color="cluster",
-                                        size="trx_count",
-                                        hover_name="hcp_id",
-                                        hover_data=hover_data_dict,
-                                        color_discrete_sequence=px.colors.qualitative.Safe, # Different color scheme
-                                        zoom=3.5,
-                                        height=600,
-                                        mapbox_style="carto-positron")
-                fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0})
-                st.plotly_chart(fig, use_container_width=True)
+                df_cleaned['cluster'] = pd.Categorical(df_cleaned['cluster'])
+                tooltip_columns = ['cluster', 'trx_count'] + [col for col in present_optional_geo if col in df_cleaned.columns]
+                map_df = df_cleaned[['hcp_id', 'latitude', 'longitude'] + tooltip_columns].copy()
+
+                # Precompute per-point colours from the cluster id so the browser just reads r/g/b
+                rgb = TERRITORY_COLORS[map_df['cluster'].cat.codes.to_numpy() % len(TERRITORY_COLORS)]
+                map_df['r'], map_df['g'], map_df['b'] = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+
+                # trx_count drives the radius (metres); scale so the busiest HCP is ~20 km across
+                radius_scale = 20_000 / max(float(map_df['trx_count'].max()), 1.0)
+                layer = pdk.Layer('ScatterplotLayer',
+                                  map_df,
+                                  get_position='[longitude, latitude]',
+                                  get_radius='trx_count',
+                                  get_fill_color='[r, g, b]',
+                                  radius_scale=radius_scale,
+                                  radius_min_pixels=2,
+                                  radius_max_pixels=15,
+                                  opacity=0.8,
+                                  pickable=True)
+                view_state = pdk.ViewState(latitude=float(map_df['latitude'].mean()),
+                                           longitude=float(map_df['longitude'].mean()),
+                                           zoom=3.5)
+                tooltip = {"html": "<b>{hcp_id}</b><br/>" + "<br/>".join(f"{col}: {{{col}}}" for col in tooltip_columns)}
+                st.pydeck_chart(pdk.Deck(layers=[layer], initial_view_state=view_state, tooltip=tooltip,
+                                         map_style="light", height=600),
+                                use_container_width=True)
             except Exception as map_error:
                 st.error(f"Error creating map: {map_error}")
 
@@ -182,10 +274,13 @@ if uploaded_file is not None:
             if present_optional_geo:
                 st.write("#### Geographic Territory Summary")
                 st.markdown(f"Count of HCPs per Territory and {', '.join(present_optional_geo)}.")
-                grouping_fields = ['cluster'] + [col for col in present_optional_geo if col in gdf.columns]
-                if len(grouping_fields) > 1 and 'cluster' in gdf.columns:
-                    geo_summary = gdf.dropna(subset=['cluster']).groupby(grouping_fields).size().reset_index(name='HCP Count')
-                    st.dataframe(geo_summary.sort_values(by=['cluster'] + [col for col in present_optional_geo if col in gdf.columns]))
+                grouping_fields = ['cluster'] + [col for col in present_optional_geo if col in df_cleaned.columns]
+                if len(grouping_fields) > 1 and 'cluster' in df_cleaned.columns:
+                    # Categorical keys group on compact integer codes; observed=True skips unused
+                    # combinations and sort=False defers ordering to the sort_values below
+                    summary_keys = df_cleaned[grouping_fields].astype('category')
+                    geo_summary = summary_keys.groupby(grouping_fields, observed=True, sort=False).size().reset_index(name='HCP Count')
+                    st.dataframe(geo_summary.sort_values(by=['cluster'] + [col for col in present_optional_geo if col in df_cleaned.columns]))
                 else:
                     st.write("Optional geographic columns or cluster assignments not found for summary.")
                 st.markdown("*(Use this table to check if territories are geographically consistent)*")
@@ -194,11 +289,11 @@ if uploaded_file is not None:
             # --- Results Table ---
             st.write("#### Full Segmented Data Table")
             display_columns = ['hcp_id', 'trx_count', 'latitude', 'longitude'] + \
-                              [col for col in present_optional_geo if col in gdf.columns] + \
+                              [col for col in present_optional_geo if col in df_cleaned.columns] + \
                               ['cluster']
-            final_display_columns = [col for col in display_columns if col in gdf.columns]
-            if 'cluster' in gdf.columns:
-                st.dataframe(gdf[final_display_columns].sort_values('cluster'))
+            final_display_columns = [col for col in display_columns if col in df_cleaned.columns]
+            if 'cluster' in df_cleaned.columns:
+                st.dataframe(df_cleaned[final_display_columns].sort_values('cluster'))
             else:
                 st.write("Cluster information not available for the table.")
 
@@ -208,9 +303,9 @@ if uploaded_file is not None:
             st.write("### 5. Export Results")
             try:
                 output = io.BytesIO()
-                if 'cluster' in gdf.columns:
-                    df_to_save = gdf[final_display_columns]
-                    df_to_save.to_csv(output, index=False, encoding='utf-8')
+                if 'cluster' in df_cleaned.columns:
+                    df_to_save = df_cleaned[final_display_columns]
+                    pacsv.write_csv(pa.Table.from_pandas(df_to_save, preserve_index=False), output)
                     output.seek(0)
                     st.download_button(label="Download Segmented Data as CSV",
                                    data=output,
@@ -225,8 +320,8 @@ if uploaded_file is not None:
     except pd.errors.EmptyDataError:
         st.error("Error: The uploaded CSV file appears to be empty.")
     except ImportError as e_import:
-        st.error(f"ImportError: A required library (likely PySAL, spopt, or a dependency) is not installed. Details: {e_import}")
-        st.error("Please ensure your environment has all libraries from requirements.txt installed, especially GeoPandas and PySAL components.")
+        st.error(f"ImportError: A required library (likely pyproj, scikit-learn, or a dependency) is not installed. Details: {e_import}")
+        st.error("Please ensure your environment has all libraries from requirements.txt installed, especially pyproj and scikit-learn.")
     except Exception as e:
         st.error(f"An unexpected error occurred: {e}")
         st.error("Please ensure the uploaded file is valid and all dependencies are installed.")